@@ -1,18 +1,25 @@
+import asyncio
 import html
+import itertools
 import json
 import logging
+import time
 import traceback
-from io import StringIO
+from io import BytesIO, TextIOWrapper
 from os import getenv, makedirs
 from typing import Optional, TypeAlias, Literal
 from urllib.parse import urlsplit
-from uuid import uuid4
-import requests
+
+import aiohttp
 
 try:
     import re2 as re
 except ImportError:
     import re
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 import telegram.error
 from telegram import Update, InputTextMessageContent, InlineQueryResultArticle, \
     InlineQueryResultPhoto, InlineQueryResultGif, InlineQueryResultVideo, InlineQueryResult, InputMediaDocument, \
@@ -22,48 +29,102 @@ from telegram.ext import CommandHandler, CallbackContext, Application, InlineQue
 
 ContextCounters: TypeAlias = Literal["commands_handled", "messages_handled", "media_downloaded"]
 CORRECT_TWITTER_PATTERN = r"http(?:s)?:\/\/(?:www)?(twitter|x)\.com\/([a-zA-Z0-9_]+)/(status|web)/\d+"
+TWITTER_URL_RE = re.compile(CORRECT_TWITTER_PATTERN)
+TCO_RE = re.compile(r"t\.co/[a-zA-Z0-9]+")
+TWEET_ID_RE = re.compile(r"(?:twitter|x)\.com/.{1,15}/(?:web|status(?:es)?)/([0-9]{1,20})")
 
 # Enable logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
+LOG_LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR
+}
 # Grab env values
 BOT_TOKEN = getenv('BOT_TOKEN')
 DEVELOPER_ID = getenv('DEVELOPER_ID')
-
-
-def extract_tweet_ids(update: Update, text: str) -> Optional[list[str]]:
+# Shared HTTP session, created on application startup
+http_session: Optional[aiohttp.ClientSession] = None
+# Limit concurrent requests to vxtwitter
+scrape_semaphore = asyncio.Semaphore(8)
+SCRAPE_ATTEMPTS = 3
+SCRAPE_TIMEOUT = aiohttp.ClientTimeout(total=5)
+# Scraped media by tweet ID, as (expiry time, media)
+SCRAPE_CACHE_TTL = 600
+SCRAPE_CACHE_SIZE = 4096
+scrape_cache: dict[str, tuple[float, list[dict]]] = {}
+# Telegram bot API upload limit for videos sent by URL
+MAX_VIDEO_SIZE = 20 * 1024 * 1024
+# Inline result IDs only need to be unique within an answer
+inline_result_ids = itertools.count()
+
+
+async def unshorten_link(link: str) -> str:
+    async with http_session.head('https://' + link, allow_redirects=True) as r:
+        return str(r.url)
+
+
+async def extract_tweet_ids(update: Update, text: str) -> Optional[list[str]]:
     """Extract tweet IDs from message."""
 
     # For t.co links
     unshortened_links = ''
-    for link in re.findall(r"t\.co/[a-zA-Z0-9]+", text):
-        try:
-            unshortened_link = requests.get('https://' + link).url
+    links = TCO_RE.findall(text)
+    for link, unshortened_link in zip(links, await asyncio.gather(*[unshorten_link(link) for link in links],
+                                                                   return_exceptions=True)):
+        if isinstance(unshortened_link, Exception):
+            log_handling(update, 'info', f'Could not unshorten link [https://{link}]')
+        else:
             unshortened_links += '\n' + unshortened_link
             log_handling(update, 'info', f'Unshortened t.co link [https://{link} -> {unshortened_link}]')
-        except:
-            log_handling(update, 'info', f'Could not unshorten link [https://{link}]')
 
     # Parse IDs from received text
-    tweet_ids = re.findall(r"(?:twitter|x)\.com/.{1,15}/(?:web|status(?:es)?)/([0-9]{1,20})", text + unshortened_links)
-    tweet_ids = list(dict.fromkeys(tweet_ids))
-    return tweet_ids or None
+    # Dedup keeping order of appearance
+    tweet_ids = {}
+    for match in TWEET_ID_RE.finditer(text + unshortened_links):
+        tweet_ids.setdefault(match.group(1), None)
+    return list(tweet_ids) or None
 
 
-def scrape_media(tweet_id: int) -> list[dict]:
-    r = requests.get(f'https://api.vxtwitter.com/Twitter/status/{tweet_id}')
-    r.raise_for_status()
-    return r.json()['media_extended']
+async def scrape_media(tweet_id: str) -> list[dict]:
+    if (cached := scrape_cache.get(tweet_id)) and cached[0] > time.monotonic():
+        return cached[1]
+    for attempt in range(SCRAPE_ATTEMPTS):
+        try:
+            async with scrape_semaphore, http_session.get(f'https://api.vxtwitter.com/Twitter/status/{tweet_id}',
+                                                          timeout=SCRAPE_TIMEOUT) as r:
+                r.raise_for_status()
+                media = (await r.json(content_type=None))['media_extended']
+            break
+        except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+            # Only retry transient failures, a 4xx (e.g. deleted tweet) won't go away
+            if attempt == SCRAPE_ATTEMPTS - 1 or (isinstance(exc, aiohttp.ClientResponseError) and exc.status < 500):
+                raise
+            await asyncio.sleep(0.1 * 3 ** attempt)
+    # Evict the oldest entry when full
+    scrape_cache.pop(tweet_id, None)
+    if len(scrape_cache) >= SCRAPE_CACHE_SIZE:
+        del scrape_cache[next(iter(scrape_cache))]
+    scrape_cache[tweet_id] = (time.monotonic() + SCRAPE_CACHE_TTL, media)
+    return media
 
 
 def get_media(tweet_media: list) -> tuple[list, list, list]:
-    photos = [media for media in tweet_media if media["type"] == "image"]
-    gifs = [media for media in tweet_media if media["type"] == "gif"]
-    videos = [media for media in tweet_media if media["type"] == "video"]
+    photos, gifs, videos = [], [], []
+    for media in tweet_media:
+        media_type = media["type"]
+        if media_type == "image":
+            photos.append(media)
+        elif media_type == "gif":
+            gifs.append(media)
+        elif media_type == "video":
+            videos.append(media)
     return photos, gifs, videos
 
 
-def get_media_for_inline(update: Update, context: CallbackContext, tweet_media: list) -> list[InlineQueryResult]:
+async def get_media_for_inline(update: Update, context: CallbackContext, tweet_media: list) -> list[InlineQueryResult]:
     photos, gifs, videos = get_media(tweet_media)
     media_group: list[InlineQueryResult] = []
     if photos:
@@ -71,7 +132,7 @@ def get_media_for_inline(update: Update, context: CallbackContext, tweet_media:
     elif gifs:
         media_group += get_gifs(update, context, gifs)
     elif videos:
-        media_group += get_videos(update, context, videos)
+        media_group += await get_videos(update, context, videos)
     return media_group
 
 
@@ -83,7 +144,7 @@ def get_photos(update: Update, context: CallbackContext, twitter_photos: list[di
         log_handling(update, 'info', f'Photo[{len(photo)}] url: {photo_url}')
         final_url = get_photo_url(update, photo_url)
         photo_group.append(InlineQueryResultPhoto(
-            id=str(uuid4()),
+            id=str(next(inline_result_ids)),
             photo_url=final_url,
             thumbnail_url=final_url
         ))
@@ -98,7 +159,7 @@ def get_gifs(update: Update, context: CallbackContext, twitter_gifs: list[dict])
         gif_url = gif['url']
         log_handling(update, 'info', f'Gif url: {gif_url}')
         gif_group.append(InlineQueryResultGif(
-            id=str(uuid4()),
+            id=str(next(inline_result_ids)),
             thumbnail_url=str(gif['thumbnail_url']),
             gif_url=str(gif_url)
         ))
@@ -106,18 +167,29 @@ def get_gifs(update: Update, context: CallbackContext, twitter_gifs: list[dict])
     return gif_group
 
 
-def get_videos(update: Update, context: CallbackContext, twitter_videos: list[dict]) -> \
+async def get_video_size(url: str) -> int:
+    async with http_session.head(url, allow_redirects=True) as r:
+        r.raise_for_status()
+        return int(r.headers['Content-Length'])
+
+
+async def get_video_sizes(videos: list[dict]) -> list[int | Exception]:
+    """Get the size of every video concurrently, or the exception raised when checking it."""
+    return await asyncio.gather(*[get_video_size(video['url']) for video in videos], return_exceptions=True)
+
+
+async def get_videos(update: Update, context: CallbackContext, twitter_videos: list[dict]) -> \
         list[InlineQueryResultVideo]:
     """Reply with videos."""
     video_group = []
-    for video in twitter_videos:
+    for video, video_size in zip(twitter_videos, await get_video_sizes(twitter_videos)):
         video_url = video['url']
         try:
-            request = requests.get(video_url, stream=True)
-            request.raise_for_status()
-            if (video_size := int(request.headers['Content-Length'])) <= 20 * 1024 * 1024:
+            if isinstance(video_size, Exception):
+                raise video_size
+            if video_size <= MAX_VIDEO_SIZE:
                 video_group.append(InlineQueryResultVideo(
-                    id=str(uuid4()),
+                    id=str(next(inline_result_ids)),
                     thumbnail_url=video['thumbnail_url'],
                     video_url=video_url,
                     title='Video',
@@ -126,28 +198,47 @@ def get_videos(update: Update, context: CallbackContext, twitter_videos: list[di
             else:
                 log_handling(update, 'info', f'Video size ({video_size}) is too big')
                 video_group.append(InlineQueryResultArticle(
-                    id=str(uuid4()),
+                    id=str(next(inline_result_ids)),
                     title='Video too big!',
                     input_message_content=InputTextMessageContent('Video too big')
                 ))
-        except (requests.HTTPError, KeyError, telegram.error.BadRequest, requests.exceptions.ConnectionError) as exc:
+        except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError, telegram.error.BadRequest) as exc:
             log_handling(update, 'info', f'{exc.__class__.__qualname__}: {exc}')
             log_handling(update, 'info', 'Error occurred when trying to send video, sending direct link')
-            update.effective_message.reply_text(f'Error occurred when trying to send video. Direct link:\n'
-                                                f'{video_url}', quote=True)
-        print('data:', context.bot_data)
+            video_group.append(InlineQueryResultArticle(
+                id=str(next(inline_result_ids)),
+                title='Video unavailable, send direct link',
+                input_message_content=InputTextMessageContent(f'Error occurred when trying to send video. '
+                                                              f'Direct link:\n{video_url}')
+            ))
         increase_context_counter(context, "media_downloaded")
     return video_group
 
 
+def log_scrape_error(update: Update, tweet_id: str, exc: Exception) -> None:
+    log_handling(update, 'error', f'Error occurred when scraping tweet {tweet_id}: '
+                                  f'{"".join(traceback.format_exception(exc))}')
+
+
 async def grab_command(update: Update, context: CallbackContext) -> None:
     url = context.args[0]
-    if re.match(CORRECT_TWITTER_PATTERN, url):
-        tweet_ids = extract_tweet_ids(update, url)
+    scrape_error = None
+    if TWITTER_URL_RE.match(url):
+        tweet_ids = await extract_tweet_ids(update, url)
         if tweet_ids:
             await update.effective_message.reply_text(f'tweet: {url}', disable_web_page_preview=True)
-        for tweet_id in tweet_ids:
-            media = scrape_media(tweet_id)
+        medias = await asyncio.gather(*[scrape_media(tweet_id) for tweet_id in tweet_ids], return_exceptions=True)
+        for tweet_id, media in zip(tweet_ids, medias):
+            if isinstance(media, Exception):
+                # The first error is re-raised below and fully reported by error_handler
+                if scrape_error is None:
+                    log_handling(update, 'info', f'Could not scrape tweet {tweet_id}: {media!r}')
+                    scrape_error = media
+                else:
+                    log_scrape_error(update, tweet_id, media)
+                await update.effective_message.reply_text(f'Error occurred when trying to get media from tweet '
+                                                          f'{tweet_id}', quote=False)
+                continue
             photos, gifs, videos = get_media(media)
             if photos:
                 await command_send_photos(context, photos, update)
@@ -159,6 +250,9 @@ async def grab_command(update: Update, context: CallbackContext) -> None:
     else:
         await update.effective_message.reply_text("That's not a valid twitter URL or I couldn't find any media on it")
     increase_context_counter(context, "commands_handled")
+    # Let error_handler report the first failed scrape once the other tweets have been sent
+    if scrape_error:
+        raise scrape_error
 
 
 async def donate_command(update: Update, context: CallbackContext) -> None:
@@ -167,18 +261,18 @@ async def donate_command(update: Update, context: CallbackContext) -> None:
 
 
 async def command_send_videos(context: CallbackContext, videos: list, update: Update) -> None:
-    for video in videos:
+    for video, video_size in zip(videos, await get_video_sizes(videos)):
         video_url = video['url']
         try:
-            request = requests.get(video_url, stream=True)
-            request.raise_for_status()
-            if (int(request.headers['Content-Length'])) <= 20 * 1024 * 1024:
+            if isinstance(video_size, Exception):
+                raise video_size
+            if video_size <= MAX_VIDEO_SIZE:
                 await update.effective_message.reply_video(video=video_url, quote=False)
             else:
                 log_handling(update, 'info', 'Video is too large, sending direct link')
                 await update.effective_message.reply_text(f'Video is too large for Telegram upload. Link:\n'
                                                           f'{video_url}', quote=True)
-        except (requests.HTTPError, KeyError, telegram.error.BadRequest, requests.exceptions.ConnectionError) as exc:
+        except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError, telegram.error.BadRequest) as exc:
             log_handling(update, 'info', f'{exc.__class__.__qualname__}: {exc}')
             log_handling(update, 'info', 'Error occurred when trying to send video, sending direct link')
             await update.effective_message.reply_text(f'Error occurred when trying to send video. Direct link:\n'
@@ -204,16 +298,10 @@ async def command_send_photos(context: CallbackContext, photos: list, update: Up
 
 
 def get_photo_url(update, url) -> str:
-    # Try changing requested quality to 'orig'
-    parsed_url = urlsplit(url)
-    try:
-        new_url = parsed_url._replace(query='format=jpg&name=orig').geturl()
-        log_handling(update, 'info', 'New photo url: ' + new_url)
-        requests.head(new_url).raise_for_status()
-        return new_url
-    except requests.HTTPError:
-        log_handling(update, 'info', 'orig quality not available, using original url')
-        return url
+    # Request 'orig' quality, which twimg always serves
+    new_url = urlsplit(url)._replace(query='format=jpg&name=orig').geturl()
+    log_handling(update, 'info', 'New photo url: ' + new_url)
+    return new_url
 
 
 def increase_context_counter(context: CallbackContext, counter_name: ContextCounters) -> None:
@@ -232,8 +320,7 @@ def init_stats(context: CallbackContext) -> None:
 
 def log_handling(update: Update, level: str, message: str) -> None:
     """Log message with chat_id and message_id."""
-    _level = getattr(logging, level.upper())
-    logger.log(_level, f'[{update.effective_user.id}] {message}')
+    logger.log(LOG_LEVELS[level], '[%s] %s', update.effective_user.id, message)
 
 
 async def error_handler(update: object, context: CallbackContext) -> None:
@@ -253,33 +340,30 @@ async def error_handler(update: object, context: CallbackContext) -> None:
     if update is None:
         return
 
-    # traceback.format_exception returns the usual python message about an exception, but as a
-    # list of strings rather than a single string, so we have to join them together.
-    tb_list = traceback.format_exception(None, context.error, context.error.__traceback__)
-    tb_string = ''.join(tb_list)
-
-    # Build the message with some markup and additional information about what happened.
+    # Write the report with some markup and additional information about what happened straight
+    # into a buffer, so the whole report is never held as an intermediate string.
+    report = BytesIO()
+    writer = TextIOWrapper(report, encoding='utf-8')
     update_str = update.to_dict() if isinstance(update, Update) else str(update)
-    message = (
-        f'#error_report\n'
-        f'An exception was raised in runtime\n'
-        f'update = {json.dumps(update_str, indent=2, ensure_ascii=False)}'
-        '\n\n'
-        f'context.chat_data = {str(context.chat_data)}\n\n'
-        f'context.user_data = {str(context.user_data)}\n\n'
-        f'{tb_string}'
-    )
+    writer.write('#error_report\nAn exception was raised in runtime\nupdate = ')
+    json.dump(update_str, writer, indent=2, ensure_ascii=False)
+    writer.write(f'\n\ncontext.chat_data = {context.chat_data}\n\n')
+    writer.write(f'context.user_data = {context.user_data}\n\n')
+    # traceback.print_exception writes the usual python message about an exception
+    traceback.print_exception(context.error, file=writer)
+    writer.flush()
+    writer.detach()
+    report.seek(0)
 
     # Finally, send the message
     error_class_name = ".".join([context.error.__class__.__module__, context.error.__class__.__qualname__])
-    await context.bot.send_document(chat_id=DEVELOPER_ID, document=message.encode(), filename='error_report.txt',
+    await context.bot.send_document(chat_id=DEVELOPER_ID, document=report, filename='error_report.txt',
                                     caption='#error_report\nAn exception was raised:\n' +
                                             f'{error_class_name}: {str(context.error)}')
 
 
 async def stats_command(update: Update, context: CallbackContext) -> None:
     """Send stats when the command /stats is issued."""
-    print('stats in')
     if 'stats' not in context.bot_data:
         init_stats(context)
     logger.info(f'Sent stats: {context.bot_data["stats"]}')
@@ -316,24 +400,29 @@ async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     """Handle the inline query. This is run when you type: @botusername <query>"""
     query = update.inline_query.query
 
-    if not query:  # empty query should not be handled
+    # empty or non-twitter queries should not be handled
+    if not query or not TWITTER_URL_RE.match(query):
         return
 
-    tweet_ids = extract_tweet_ids(update, query)
+    tweet_ids = await extract_tweet_ids(update, query)
     results = []
-    for tweet_id in tweet_ids:
+    medias = await asyncio.gather(*[scrape_media(tweet_id) for tweet_id in tweet_ids], return_exceptions=True)
+    for tweet_id, media in zip(tweet_ids, medias):
+        if isinstance(media, Exception):
+            log_scrape_error(update, tweet_id, media)
+            continue
         try:
-            media = scrape_media(tweet_id)
             if media:
                 log_handling(update, 'info', f'tweet media: {media}')
-                results = get_media_for_inline(update, context, media)
+                results = await get_media_for_inline(update, context, media)
             else:
                 log_handling(update, 'info', f'Tweet {tweet_id} has no media')
         except Exception:
-            log_handling(update, 'error', f'Error occurred when scraping tweet {tweet_id}: {traceback.format_exc()}')
+            log_handling(update, 'error', f'Error occurred when building inline results for tweet {tweet_id}: '
+                                          f'{traceback.format_exc()}')
     if len(results) == 0:
         results.append(InlineQueryResultArticle(
-            id=str(uuid4()),
+            id=str(next(inline_result_ids)),
             title="There's nothing I can get for you there!",
             input_message_content=InputTextMessageContent("There's nothing I can get for you there!"),
         ))
@@ -341,12 +430,36 @@ async def inline_query(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     await update.inline_query.answer(results)
 
 
+async def post_init(application: Application) -> None:
+    """Open the shared HTTP session once the event loop is running."""
+    global http_session
+    connector = aiohttp.TCPConnector(limit=64, limit_per_host=16)
+    http_session = aiohttp.ClientSession(connector=connector, headers={'User-Agent': 'twitter_downloader_bot'})
+    # Pre-warm the connection pool so the first query skips the TLS handshake
+    try:
+        async with http_session.head('https://api.vxtwitter.com/', timeout=aiohttp.ClientTimeout(total=5)):
+            pass
+    except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+        logger.warning(f'Could not pre-warm vxtwitter connection: {exc}')
+
+
+async def post_shutdown(application: Application) -> None:
+    """Close the shared HTTP session."""
+    if http_session is not None:
+        await http_session.close()
+
+
 def main() -> None:
     """Run the bot."""
+    # Use the faster uvloop event loop when available
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
     # Create the Application and pass it bot token and persistence
     makedirs('data', exist_ok=True)
     persistence = PicklePersistence(filepath="data/persistence")
-    application = Application.builder().token(BOT_TOKEN).persistence(persistence).build()
+    application = Application.builder().token(BOT_TOKEN).persistence(persistence) \
+        .post_init(post_init).post_shutdown(post_shutdown).build()
 
     # on different commands - answer in Telegram
     application.add_handler(CommandHandler("start", start))
@@ -356,8 +469,9 @@ def main() -> None:
     application.add_handler(CommandHandler("resetstats", reset_stats_command, filters.Chat(int(DEVELOPER_ID))))
     application.add_handler(CommandHandler("donate", donate_command))
 
-    # on inline queries - show corresponding inline results
-    application.add_handler(InlineQueryHandler(inline_query, CORRECT_TWITTER_PATTERN))
+    # on inline queries - show corresponding inline results, filtered by TWITTER_URL_RE in the callback
+    # since PTB matches its pattern argument with the stdlib re module and can't take a re2 pattern
+    application.add_handler(InlineQueryHandler(inline_query))
 
     # Register error handler
     application.add_error_handler(error_handler)